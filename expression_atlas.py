@@ -5,7 +5,154 @@
 import argparse
 import sys
 import os
-import json
+import csv
+from pathlib import Path
+from string import Template
+import orjson
+import numpy as np
+
+# Page template
+TEMPLATE = Template("""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
+<link rel="stylesheet" href="https://cdn.datatables.net/1.10.24/css/dataTables.bootstrap4.min.css">
+<script src="https://ajax.googleapis.com/ajax/libs/jquery/3.5.1/jquery.min.js"></script>
+<script src="https://cdn.datatables.net/1.10.24/js/jquery.dataTables.min.js"></script>
+<script src="https://cdn.datatables.net/1.10.24/js/dataTables.bootstrap4.min.js"></script>
+<script src="https://cdnjs.cloudflare.com/ajax/libs/apexcharts/4.4.0/apexcharts.min.js"></script>
+</head>
+<body>
+  <div class="container">
+<h1 class="mt-4 mb-4">Gene Expression Atlas</h1><div class="card mb-4">
+  <div class="card-body">
+<h5 class="card-title">Line Chart</h5>
+<div id="lineChart"></div>
+  </div>
+</div>
+<div class="card mb-4">
+  <div class="card-body">
+<h5 class="card-title">Bar Chart</h5>
+<div id="barChart"></div>
+  </div>
+</div>
+<div class="card mb-4">
+  <div class="card-body">
+<h5 class="card-title">Heatmap</h5>
+<div id="heatmapChart"></div>
+  </div>
+</div>
+<div class="card mb-4">
+  <div class="card-body">
+<h5 class="card-title">Replicates Chart</h5>
+<label for="geneSelect">Select gene:</label><br/>
+<select id="geneSelect" class="form-control mb-3">
+$options</select>
+<div id="dotChart"></div>
+  </div>
+</div>
+<div class="card mb-4">
+  <div class="card-body">
+<h5 class="card-title">Expression Data Table</h5>
+<div class="table-responsive">
+<table id="datatable" class="display table table-striped table-bordered" border="0">
+<thead><tr>
+<th>Gene ID</th>
+$sample_headers$annot_headers</tr></thead><tbody>
+$tbody</tbody></table>
+</div></div>
+<script>
+var lineSeries=$line_series;
+var barSeries=lineSeries;
+var dotData=$dot_data;
+var categories=$categories;
+var heatmapGenes=$heatmap_genes;
+var heatmapFlat=new Float32Array([$heatmap_flat]);
+var heatmapSeries=[];
+for(var hi=heatmapGenes.length-1;hi>=0;hi--){
+    var hrow=[];
+    for(var hj=0;hj<categories.length;hj++){
+        var hv=heatmapFlat[hi*categories.length+hj];
+        hrow.push({x:categories[hj],y:isNaN(hv)?null:Math.round(hv*100)/100});
+    }
+    heatmapSeries.push({name:heatmapGenes[hi],data:hrow});
+}
+
+            var lineOptions={
+                chart:{type:'line',height:400},
+                series:lineSeries,
+                xaxis:{categories:categories},
+                dataLabels:{enabled:true},
+                legend:{position:'top'}
+            };
+            var lineChart=new ApexCharts(document.querySelector('#lineChart'),lineOptions);
+            lineChart.render();
+        
+            var barOptions={
+                chart:{type:'bar',height:400},
+                series:barSeries,
+                xaxis:{categories:categories},
+                plotOptions:{bar:{dataLabels:{position:'top'}}},
+                dataLabels:{enabled:true,style:{colors:['#fff']},background:{enabled:true,foreColor:'#000'}},
+                legend:{position:'top'}
+            };
+            var barChart=new ApexCharts(document.querySelector('#barChart'),barOptions);
+            barChart.render();
+        
+            var heatmapOptions={
+                chart:{type:'heatmap',height:$heatmap_height},
+                series:heatmapSeries,
+                xaxis:{type:'category'},
+                plotOptions:{
+                    heatmap:{
+                        useFillColorAsStroke:true,
+                        colorScale:{
+                            ranges:$color_ranges
+                        }
+                    }
+                },
+                dataLabels:{enabled:true,style:{colors:['#fff']}}
+            };
+            var heatmapChart=new ApexCharts(document.querySelector('#heatmapChart'),heatmapOptions);
+            heatmapChart.render();
+        
+            var scatterOptions={
+                chart:{type:'scatter',height:400},
+                series:dotData['$first_gene'],
+                xaxis:{type:'category',categories:categories},
+                markers:{size:6},
+                legend:{position:'top'}
+            };
+            var dotChart=new ApexCharts(document.querySelector('#dotChart'),scatterOptions);
+            dotChart.render();
+            var sel=document.querySelector('#geneSelect');
+            sel.addEventListener('change',function(){if(dotData[this.value])dotChart.updateSeries(dotData[this.value]);});
+        $$(function(){$$("#datatable").DataTable();});
+</script>
+</div>
+</body>
+</html>""")
+
+# JSON
+def jdump(obj):
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+# Row values
+def parse_row(rest, delim, n):
+    try:
+        vals = np.fromstring(rest, dtype=np.float32, sep=delim)
+    except ValueError:
+        vals = np.empty(0, dtype=np.float32)
+    if vals.size == n:
+        return vals
+    out = np.full(n, np.nan, dtype=np.float32)
+    for j, x in enumerate(rest.split(delim)[:n]):
+        try:
+            out[j] = float(x)
+        except ValueError:
+            pass
+    return out
 
 # Delimiter
 def detect_delimiter(line):
@@ -46,93 +193,90 @@ def main():
         annot_file = None
 
     # Read genes
-    with open(genes_file, encoding='utf-8') as f:
-        gene_list = [l.strip() for l in f if l.strip()]
-    gene_set = set(gene_list)
+    gene_list = Path(genes_file).read_text(encoding='utf-8').split()
+    gene_set = frozenset(gene_list)
 
     # Read matrix
-    group_to_indices = {}
     group_order = []
-    expression_data = {}
+    group_index = {}
     with open(matrix_file, encoding='utf-8') as mf:
         header = mf.readline().strip()
         delim = detect_delimiter(header)
         cols = header.split(delim)
-        samples = cols[1:]
-        for i, s in enumerate(samples):
-            if s not in group_to_indices:
-                group_to_indices[s] = []
+        samples = [sys.intern(s) for s in cols[1:]]
+        for s in samples:
+            if s not in group_index:
+                group_index[s] = len(group_order)
                 group_order.append(s)
-            group_to_indices[s].append(i)
+        n_samples = len(samples)
+        group_id = np.array([group_index[s] for s in samples], dtype=np.int32)
+        group_sizes = np.bincount(group_id, minlength=len(group_order))
+        matched = {}
         for line in mf:
-            parts = line.strip().split(delim)
-            gene = parts[0]
+            cut = line.find(delim)
+            gene = line[:cut] if cut != -1 else line.rstrip('\r\n')
             if gene in gene_set:
-                vals = []
-                for x in parts[1:]:
-                    try:
-                        vals.append(float(x))
-                    except:
-                        vals.append(None)
-                expression_data[gene] = vals
-                if len(expression_data) == len(gene_set):
+                matched[gene] = line[cut + 1:].rstrip('\r\n') if cut != -1 else ''
+                if len(matched) == len(gene_set):
                     break
 
+    # Compute group means
+    n_groups = len(group_order)
+    filtered_genes = [g for g in gene_list if g in matched]
+    M = np.empty((len(filtered_genes), n_samples), dtype=np.float32)
+    for i, g in enumerate(filtered_genes):
+        M[i] = parse_row(matched[g], delim, n_samples)
+    valid = ~np.isnan(M)
+    sums = np.zeros((len(filtered_genes), n_groups), dtype=np.float64)
+    counts = np.zeros((len(filtered_genes), n_groups), dtype=np.int64)
+    np.add.at(sums.T, group_id, np.where(valid, M, 0).T)
+    np.add.at(counts.T, group_id, valid.T)
+    with np.errstate(invalid='ignore'):
+        means = np.round(sums / counts, 2)
+
     # Read annotations
     annot_headers = []
     annot_data = {}
     gene_col = 0
     if annot_file:
-        with open(annot_file, encoding='utf-8') as af:
-            first = af.readline().strip()
-            sep = detect_delimiter(first)
-            hdr = first.split(sep)
-            annot_headers = hdr
+        with open(annot_file, newline='', encoding='utf-8') as af:
+            sep = detect_delimiter(af.readline().strip())
+            af.seek(0)
+            reader = csv.reader(af, delimiter=sep)
+            annot_headers = next(reader, [])
             for idx, h in enumerate(annot_headers):
                 if 'gene' in h.lower() and 'id' in h.lower():
                     gene_col = idx
                     break
-            for line in af:
-                parts = line.strip().split(detect_delimiter(line))
+            for parts in reader:
                 if len(parts) > gene_col:
                     annot_data[parts[gene_col]] = parts
 
     # Build series
-    line_series = []
-    heatmap_series = []
-    for g in gene_list:
-        if g not in expression_data:
-            continue
-        vals = expression_data[g]
-        means = []
-        pts = []
-        for s in group_order:
-            idxs = group_to_indices[s]
-            v = [vals[i] for i in idxs if i < len(vals) and vals[i] is not None]
-            m = round(sum(v) / len(v), 2) if v else None
-            means.append(m)
-            pts.append({'x': s, 'y': m})
-        line_series.append({'name': g, 'data': means})
-        heatmap_series.append({'name': g, 'data': pts})
-    heatmap_series.reverse()
+    means_obj = means.astype(object)
+    means_obj[np.isnan(means)] = None
+    means_list = means_obj.tolist()
+    line_series = [{'name': g, 'data': row} for g, row in zip(filtered_genes, means_list)]
+    flat = np.char.mod('%s', means.ravel())
+    flat[np.isnan(means.ravel())] = 'NaN'
+    heatmap_flat = ','.join(flat.tolist())
 
     # Build replicates series
-    max_reps = max(len(v) for v in group_to_indices.values())
-    dot_data = {}
-    for g in gene_list:
-        if g not in expression_data:
-            continue
-        vals = expression_data[g]
-        ser = []
-        for r in range(max_reps):
-            dpts = []
-            for s in group_order:
-                idxs = group_to_indices[s]
-                if r < len(idxs) and idxs[r] < len(vals) and vals[idxs[r]] is not None:
-                    dpts.append({'x': s, 'y': round(vals[idxs[r]], 2)})
-            if dpts:
-                ser.append({'name': f'Rep {r+1}', 'data': dpts})
-        dot_data[g] = ser
+    max_reps = int(group_sizes.max())
+    starts = np.cumsum(group_sizes) - group_sizes
+    order = np.argsort(group_id, kind='stable')
+    rep_idx = np.empty(n_samples, dtype=np.int64)
+    rep_idx[order] = np.arange(n_samples) - np.repeat(starts, group_sizes)
+    dot_data = {g: [] for g in filtered_genes}
+    for r in range(max_reps):
+        cols = np.where(rep_idx == r)[0]
+        cols = cols[np.argsort(group_id[cols], kind='stable')]
+        names = [group_order[gi] for gi in group_id[cols]]
+        vals = np.round(M[:, cols].astype(np.float64), 2).tolist()
+        for i, g in enumerate(filtered_genes):
+            pts = [{'x': s, 'y': v} for s, v in zip(names, vals[i]) if v == v]
+            if pts:
+                dot_data[g].append({'name': f'Rep {r+1}', 'data': pts})
 
     # Heatmap color ranges
     color_ranges = [
@@ -150,160 +294,44 @@ def main():
     ]
 
     # Write HTML
-    with open(output_file, 'w', encoding='utf-8') as out:
-
-        # Header
-        out.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n')
-
-        out.write('<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">\n')
-        out.write('<link rel="stylesheet" href="https://cdn.datatables.net/1.10.24/css/dataTables.bootstrap4.min.css">\n')
-        out.write('<script src="https://ajax.googleapis.com/ajax/libs/jquery/3.5.1/jquery.min.js"></script>\n')
-        out.write('<script src="https://cdn.datatables.net/1.10.24/js/jquery.dataTables.min.js"></script>\n')
-        out.write('<script src="https://cdn.datatables.net/1.10.24/js/dataTables.bootstrap4.min.js"></script>\n')
-        out.write('<script src="https://cdnjs.cloudflare.com/ajax/libs/apexcharts/4.4.0/apexcharts.min.js"></script>\n')
-
-        out.write('</head>\n<body>\n  <div class="container">\n')
-
-        # Title
-        out.write('<h1 class="mt-4 mb-4">Gene Expression Atlas</h1>')
-
-        # Line Chart
-        out.write('<div class="card mb-4">\n  <div class="card-body">\n')
-        out.write('<h5 class="card-title">Line Chart</h5>\n')
-        out.write('<div id="lineChart"></div>\n  </div>\n</div>\n')
-
-        # Bar Chart
-        out.write('<div class="card mb-4">\n  <div class="card-body">\n')
-        out.write('<h5 class="card-title">Bar Chart</h5>\n')
-        out.write('<div id="barChart"></div>\n  </div>\n</div>\n')
-
-        # Heatmap
-        out.write('<div class="card mb-4">\n  <div class="card-body">\n')
-        out.write('<h5 class="card-title">Heatmap</h5>\n')
-        out.write('<div id="heatmapChart"></div>\n  </div>\n</div>\n')
-
-        # Replicates Chart
-        out.write('<div class="card mb-4">\n  <div class="card-body">\n')
-        out.write('<h5 class="card-title">Replicates Chart</h5>\n')
-        out.write('<label for="geneSelect">Select gene:</label><br/>\n')
-        out.write('<select id="geneSelect" class="form-control mb-3">\n')
-        for g in gene_list:
-            out.write(f'  <option value="{g}">{g}</option>\n')
-        out.write('</select>\n')
-        out.write('<div id="dotChart"></div>\n  </div>\n</div>\n')
-
-        # Datatable
-        out.write('<div class="card mb-4">\n  <div class="card-body">\n')
-        out.write('<h5 class="card-title">Expression Data Table</h5>\n')
-        out.write('<div class="table-responsive">\n')
-        out.write('<table id="datatable" class="display table table-striped table-bordered" border="0">\n')
-        out.write('<thead><tr>\n')
-        out.write('<th>Gene ID</th>\n')
-        for s in group_order:
-            for r in range(len(group_to_indices[s])):
-                out.write(f'<th>{s} ({r+1})</th>')
-        if annot_headers:
-            for i, c in enumerate(annot_headers):
-                if i == gene_col:
-                    continue
-                out.write(f'<th>{c}</th>')
-        out.write('</tr></thead><tbody>\n')
-        for g in gene_list:
-            if g not in expression_data:
-                continue
-            out.write('<tr>')
-            out.write(f'<td>{g}</td>')
-            for s in group_order:
-                for idx in group_to_indices[s]:
-                    val = expression_data[g][idx] if idx < len(expression_data[g]) else None
-                    cell = round(val, 2) if val is not None else ''
-                    out.write(f'<td>{cell}</td>')
-            if annot_headers:
-                ann = annot_data.get(g, [])
-                for i, c in enumerate(annot_headers):
-                    if i == gene_col: continue
-                    v = ann[i] if i < len(ann) else ''
-                    out.write(f'<td>{v}</td>')
-            out.write('</tr>\n')
-        out.write('</tbody></table>\n')
-        out.write('</div></div>\n')
-
-        # Scripts
-        out.write('<script>\n')
-        out.write(f'var lineSeries={json.dumps(line_series)};\n')
-        out.write(f'var barSeries={json.dumps(line_series)};\n')
-        out.write(f'var heatmapSeries={json.dumps(heatmap_series)};\n')
-        out.write(f'var dotData={json.dumps(dot_data)};\n')
-        out.write(f'var categories={json.dumps(group_order)};\n')
-
-        # Line chart
-        out.write("""
-            var lineOptions={
-                chart:{type:'line',height:400},
-                series:lineSeries,
-                xaxis:{categories:categories},
-                dataLabels:{enabled:true},
-                legend:{position:'top'}
-            };
-            var lineChart=new ApexCharts(document.querySelector('#lineChart'),lineOptions);
-            lineChart.render();
-        """)
-
-        # Bar chart
-        out.write("""
-            var barOptions={
-                chart:{type:'bar',height:400},
-                series:barSeries,
-                xaxis:{categories:categories},
-                plotOptions:{bar:{dataLabels:{position:'top'}}},
-                dataLabels:{enabled:true,style:{colors:['#fff']},background:{enabled:true,foreColor:'#000'}},
-                legend:{position:'top'}
-            };
-            var barChart=new ApexCharts(document.querySelector('#barChart'),barOptions);
-            barChart.render();
-        """)
-
-        # Heatmap
-        out.write(f"""
-            var heatmapOptions={{
-                chart:{{type:'heatmap',height:{max(400,30*len(heatmap_series))}}},
-                series:heatmapSeries,
-                xaxis:{{type:'category'}},
-                plotOptions:{{
-                    heatmap:{{
-                        useFillColorAsStroke:true,
-                        colorScale:{{
-                            ranges:{json.dumps(color_ranges)}
-                        }}
-                    }}
-                }},
-                dataLabels:{{enabled:true,style:{{colors:['#fff']}}}}
-            }};
-            var heatmapChart=new ApexCharts(document.querySelector('#heatmapChart'),heatmapOptions);
-            heatmapChart.render();
-        """)
-
-        # Replicates chart
-        first = gene_list[0] if gene_list else ''
-        out.write(f"""
-            var scatterOptions={{
-                chart:{{type:'scatter',height:400}},
-                series:dotData['{first}'],
-                xaxis:{{type:'category',categories:categories}},
-                markers:{{size:6}},
-                legend:{{position:'top'}}
-            }};
-            var dotChart=new ApexCharts(document.querySelector('#dotChart'),scatterOptions);
-            dotChart.render();
-            var sel=document.querySelector('#geneSelect');
-            sel.addEventListener('change',function(){{if(dotData[this.value])dotChart.updateSeries(dotData[this.value]);}});
-        """)
-
-        # Datatable
-        out.write('$(function(){$("#datatable").DataTable();});\n')
+    options = ''.join(f'  <option value="{g}">{g}</option>\n' for g in gene_list)
+    sample_headers = ''.join(f'<th>{s} ({r+1})</th>' for gi, s in enumerate(group_order)
+                             for r in range(group_sizes[gi]))
+    annot_cols = ''
+    if annot_headers:
+        annot_cols = ''.join(f'<th>{c}</th>' for i, c in enumerate(annot_headers)
+                             if i != gene_col)
+    col_order = np.argsort(group_id, kind='stable')
+    table_vals = M[:, col_order]
+    cells = np.char.mod('%.2f', table_vals)
+    cells[np.isnan(table_vals)] = ''
+    cell_rows = ['</td><td>'.join(r) for r in cells.tolist()]
+    if annot_headers:
+        annot_idx = [i for i in range(len(annot_headers)) if i != gene_col]
+        annot_rows = [''.join('<td>%s</td>' % (ann[i] if i < len(ann) else '')
+                              for i in annot_idx)
+                      for ann in (annot_data.get(g, []) for g in filtered_genes)]
+    else:
+        annot_rows = [''] * len(filtered_genes)
+    tbody = ''.join('<tr><td>%s</td><td>%s</td>%s</tr>\n' % t
+                    for t in zip(filtered_genes, cell_rows, annot_rows))
+    html = TEMPLATE.substitute(
+        options=options,
+        sample_headers=sample_headers,
+        annot_headers=annot_cols,
+        tbody=tbody,
+        line_series=jdump(line_series),
+        heatmap_genes=jdump(filtered_genes),
+        heatmap_flat=heatmap_flat,
+        dot_data=jdump(dot_data),
+        categories=jdump(group_order),
+        heatmap_height=max(400, 30 * len(filtered_genes)),
+        color_ranges=jdump(color_ranges),
+        first_gene=gene_list[0] if gene_list else '')
 
-        # End function
-        out.write('</script>\n</div>\n</body>\n</html>')
+    # Flush the whole document in one write
+    with open(output_file, 'w', encoding='utf-8') as out:
+        out.write(html)
 
 
 # Call the function